@@ -1,16 +1,22 @@
 import os
+import re
 import uvicorn
 import logging
+import functools
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime
-from typing import List
+from html import unescape
+from typing import AsyncIterator, Awaitable, Callable, List, TypeVar
 import asyncio
 import httpx
-from bs4 import BeautifulSoup
+from lxml import etree, html as lhtml
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, field_validator
-from playwright.async_api import async_playwright, Browser, Playwright
-from tenacity import retry, stop_after_attempt, wait_exponential
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page, Playwright, Route
 
 # Cấu hình
 class Settings:
@@ -22,14 +28,69 @@ class Settings:
     )
     TIMEOUT = 20.0
     MAX_PAGES = 50
+    BROWSER_CONTEXTS = 2
+    BROWSER_MAX_PAGES = 100
+    BROWSER_MAX_AGE = 3600
+    CACHE_TTL = 600
 
 settings = Settings()
 
+# Regex dùng để làm sạch HTML trong cột lý do của HSX
+_TAG_RE = re.compile(r"<[^>]+>")
+_WS_RE = re.compile(r"\s+")
+
+# XPath biên dịch sẵn để lấy các dòng của bảng dữ liệu HNX
+_HNX_ROWS = etree.XPath('//table[@id="_tableDatas"]//tbody//tr')
+
+# Ngày lặp lại rất nhiều giữa các dòng nên cache kết quả chuyển đổi
+@functools.lru_cache(maxsize=4096)
+def _to_iso(value: str) -> str:
+    return datetime.strptime(value, "%d/%m/%Y").strftime("%Y-%m-%d")
+
+T = TypeVar("T")
+
+def _retry_after_seconds(response: httpx.Response) -> float:
+    # Tôn trọng header Retry-After (tính bằng giây) khi máy chủ giới hạn tốc độ
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0.0
+
+def _retry_after(error: Exception) -> float:
+    if isinstance(error, httpx.HTTPStatusError):
+        return _retry_after_seconds(error.response)
+    return 0.0
+
+def _is_retryable_http(error: Exception) -> bool:
+    # Chỉ thử lại lỗi mạng, 429 và 5xx; các lỗi 4xx khác sẽ không tự hết
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+async def with_retry(
+    coro_factory: Callable[[], Awaitable[T]],
+    attempts: int = 3,
+    base: float = 2.0,
+    cap: float = 10.0,
+    retry_if: Callable[[Exception], bool] = lambda error: True
+) -> T:
+    for attempt in range(attempts):
+        try:
+            return await coro_factory()
+        except Exception as e:
+            if attempt == attempts - 1 or not retry_if(e):
+                raise
+            delay = min(cap, max(base * 2 ** attempt, _retry_after(e)))
+            logging.info(f"Lỗi lần {attempt + 1}: {e}. Thử lại sau {delay:.1f} giây.")
+            await asyncio.sleep(delay)
+
 app = FastAPI(
     title="Stock Crawler API",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url=None
+    redoc_url=None,
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -40,30 +101,46 @@ app.add_middleware(
 )
 
 # Models
-class StockItem(BaseModel):
+# Dataclass có __slots__ nhẹ hơn model Pydantic và được orjson serialize trực tiếp
+@dataclass(slots=True)
+class StockItem:
     ticker: str
     name: str
     date: str
     reason: str
     exchange: str
 
-    @field_validator("date")
-    def validate_date(cls, value):
-        try:
-            datetime.strptime(value, "%Y-%m-%d")
-            return value
-        except ValueError:
-            raise ValueError("Invalid date format")
-
 class APIResponse(BaseModel):
     data: List[StockItem]
     metadata: dict
 
 # HSX Crawler
 class HSXCrawler:
-    @staticmethod
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
-    async def fetch_page(page: int) -> List[dict]:
+    # Giới hạn số request đồng thời tới HSX cho mọi lần crawl để tránh bị 429
+    CONCURRENCY = 8
+    _client: httpx.AsyncClient = None
+    _start_lock = asyncio.Lock()
+    _semaphore = asyncio.Semaphore(CONCURRENCY)
+    _resume_at = 0.0
+
+    @classmethod
+    async def start(cls) -> None:
+        # Dùng chung một client để tái sử dụng kết nối TCP/TLS giữa các request
+        cls._client = httpx.AsyncClient(
+            http2=True,
+            timeout=settings.TIMEOUT,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+            headers={"User-Agent": settings.USER_AGENT}
+        )
+
+    @classmethod
+    async def close(cls) -> None:
+        if cls._client:
+            await cls._client.aclose()
+            cls._client = None
+
+    @classmethod
+    async def fetch_page(cls, client: httpx.AsyncClient, page: int) -> dict:
         params = {
             "_search": "false",
             "rows": 30,
@@ -72,130 +149,245 @@ class HSXCrawler:
             "sord": "desc"
         }
 
-        async with httpx.AsyncClient(timeout=settings.TIMEOUT) as client:
-            response = await client.get(
-                settings.HSX_URL,
-                params=params,
-                headers={"User-Agent": settings.USER_AGENT}
-            )
+        async def request() -> dict:
+            # Khi HSX báo 429, mọi request đều tạm dừng đến hết Retry-After (không giữ semaphore)
+            while True:
+                delay = cls._resume_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                async with cls._semaphore:
+                    # Kiểm tra lại sau khi có permit vì có thể đã có 429 trong lúc xếp hàng
+                    if cls._resume_at <= time.monotonic():
+                        response = await client.get(settings.HSX_URL, params=params)
+                        break
+            if response.status_code == 429:
+                retry_after = _retry_after_seconds(response)
+                # Thời gian chờ quá dài thì báo lỗi ngay thay vì treo mọi request /stocks
+                if retry_after > settings.TIMEOUT:
+                    raise RuntimeError(f"HSX giới hạn tốc độ, yêu cầu chờ {retry_after:.0f} giây")
+                cls._resume_at = max(cls._resume_at, time.monotonic() + retry_after)
             response.raise_for_status()
-            return response.json().get("rows", [])
+            return response.json()
+
+        return await with_retry(request, retry_if=_is_retryable_http)
+
+    @classmethod
+    async def crawl(cls) -> List["StockItem"]:
+        # Khóa để các request đồng thời không tạo nhiều client khi chưa khởi tạo
+        async with cls._start_lock:
+            if not cls._client:
+                await cls.start()
+        client = cls._client
+
+        # Trang đầu tiên quyết định có dữ liệu hay không
+        first = await cls.fetch_page(client, 1)
+        first_rows = first.get("rows", [])
+        if not first_rows:
+            return []
+
+        # jqGrid trả về tổng số trang trong "total", chỉ tải đúng số trang cần thiết
+        try:
+            total_pages = min(int(first.get("total", settings.MAX_PAGES)), settings.MAX_PAGES)
+        except (TypeError, ValueError):
+            total_pages = settings.MAX_PAGES
+
+        async def fetch(page: int) -> List[dict]:
+            return (await cls.fetch_page(client, page)).get("rows", [])
+
+        # Các trang còn lại được tải song song, giữ nguyên thứ tự trang
+        pages = await asyncio.gather(*[fetch(p) for p in range(2, total_pages + 1)])
+
+        items = cls.process_data(first_rows)
+        for rows in pages:
+            # Dừng tại trang trống đầu tiên như vòng lặp tuần tự trước đây
+            if not rows:
+                break
+            items.extend(cls.process_data(rows))
+        return items
 
     @staticmethod
     def process_data(rows: List[dict]) -> List[StockItem]:
+        # Dữ liệu đã được chuẩn hóa (ngày ISO) qua _to_iso
         return [
             StockItem(
-                ticker=row["cell"][1].strip(),
-                name=row["cell"][4].strip(),
-                date=datetime.strptime(row["cell"][5], "%d/%m/%Y").strftime("%Y-%m-%d"),
-                reason=BeautifulSoup(row["cell"][6], "html.parser").get_text().strip(),
+                ticker=cells[1].strip(),
+                name=cells[4].strip(),
+                date=_to_iso(cells[5]),
+                reason=unescape(_WS_RE.sub(" ", _TAG_RE.sub("", cells[6]))).strip(),
                 exchange="HOSE"
             )
-            for row in rows if len(row.get("cell", [])) >= 7
+            for row in rows if len(cells := row.get("cell", [])) >= 7
         ]
 
-# # HNX Crawler
-# class HNXCrawler:
-#     _browser: Browser = None
-#     _playwright: Playwright = None
-
-#     @classmethod
-#     async def get_browser(cls) -> Browser:
-#         if not cls._browser or not cls._browser.is_connected():
-#             # Khởi tạo phiên bản Playwright trước
-#             cls._playwright = await async_playwright().start()
-#             cls._browser = await cls._playwright.chromium.launch(
-#                 headless=True,
-#                 args=["--no-sandbox", "--disable-dev-shm-usage"]
-#             )
-#         return cls._browser
-
-#     @staticmethod
-#     def parse_html(html: str) -> List[StockItem]:
-#         soup = BeautifulSoup(html, "html.parser")
-#         return [
-#             StockItem(
-#                 ticker=cols[1].get_text(strip=True),
-#                 name=cols[2].get_text(strip=True),
-#                 date=datetime.strptime(cols[3].get_text(strip=True), "%d/%m/%Y").strftime("%Y-%m-%d"),
-#                 reason=cols[4].get_text(strip=True).replace("- ", ""),
-#                 exchange="HNX"
-#             )
-#             for row in soup.select("table#_tableDatas tbody tr")
-#             if (cols := row.find_all("td")) and len(cols) >= 5
-#         ]
-
-#     @classmethod
-#     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
-#     async def crawl(cls) -> List[StockItem]:
-#         browser = await cls.get_browser()
-#         context = await browser.new_context()
-
-#         try:
-#             page = await context.new_page()
-#             await page.goto(settings.HNX_URL, wait_until="domcontentloaded", timeout=60000)
-
-#             items = []
-#             # Hạn chế số lần lặp nếu cần
-#             for _ in range(settings.MAX_PAGES):
-#                 content = await page.content()
-#                 items += cls.parse_html(content)
-
-#                 # Lấy container chứa phân trang và tìm phần tử "next" bên trong nó.
-#                 container = page.locator("div#d_page div#d_number_of_page")
-#                 next_button = container.locator("li:has(span#next) span#next")
-
-#                 # Kiểm tra xem phần tử next có tồn tại không
-#                 if await next_button.count() == 0:
-#                     break
-
-#                 # Nếu nút next đang ở trạng thái disable thì thoát vòng lặp
-#                 if await next_button.is_disabled():
-#                     break
-
-#                 await next_button.click()
-#                 await page.wait_for_load_state("domcontentloaded")
-
-#             return items
-#         finally:
-#             await context.close()
+# HNX Crawler
+class BrowserPool:
+    """Giữ một Chromium và một số context dùng lại giữa các request."""
+
+    def __init__(
+        self,
+        size: int = settings.BROWSER_CONTEXTS,
+        max_pages_per_browser: int = settings.BROWSER_MAX_PAGES,
+        max_age_seconds: float = settings.BROWSER_MAX_AGE,
+        route_handler: Callable[[Route], Awaitable[None]] = None
+    ):
+        self.size = size
+        self.max_pages_per_browser = max_pages_per_browser
+        self.max_age_seconds = max_age_seconds
+        self.route_handler = route_handler
+        self._playwright: Playwright = None
+        self._browser: Browser = None
+        self._contexts: asyncio.Queue = None
+        self._lock = asyncio.Lock()
+        self._in_use = 0
+        self._pages_served = 0
+        self._launched_at = 0.0
+
+    async def start(self) -> None:
+        self._playwright = await async_playwright().start()
+        await self._launch()
+
+    async def close(self) -> None:
+        await self._shutdown_browser()
+        if self._playwright:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def _launch(self) -> None:
+        self._browser = await self._playwright.chromium.launch(
+            headless=True,
+            args=["--no-sandbox", "--disable-dev-shm-usage"]
+        )
+        self._contexts = asyncio.Queue()
+        try:
+            for _ in range(self.size):
+                context = await self._browser.new_context()
+                self._contexts.put_nowait(context)
+                if self.route_handler:
+                    await context.route("**/*", self.route_handler)
+        except Exception:
+            # Pool thiếu context sẽ làm page() chờ mãi, nên đóng hẳn để lần sau khởi động lại
+            await self._shutdown_browser()
+            raise
+        self._pages_served = 0
+        self._launched_at = time.monotonic()
+
+    async def _shutdown_browser(self) -> None:
+        if self._contexts:
+            while not self._contexts.empty():
+                context: BrowserContext = self._contexts.get_nowait()
+                try:
+                    await context.close()
+                except Exception as e:
+                    logging.info(f"Lỗi khi đóng context: {e}")
+        if self._browser:
+            try:
+                await self._browser.close()
+            except Exception as e:
+                logging.info(f"Lỗi khi đóng trình duyệt: {e}")
+            self._browser = None
+
+    def _needs_recycle(self) -> bool:
+        return (
+            self._browser is None
+            or not self._browser.is_connected()
+            or self._pages_served >= self.max_pages_per_browser
+            or time.monotonic() - self._launched_at >= self.max_age_seconds
+        )
+
+    @asynccontextmanager
+    async def page(self) -> AsyncIterator[Page]:
+        async with self._lock:
+            # Chỉ khởi động lại Chromium khi không còn context nào đang được dùng
+            if self._in_use == 0 and self._needs_recycle():
+                logging.info("Khởi động lại trình duyệt để giải phóng bộ nhớ.")
+                await self._shutdown_browser()
+                await self._launch()
+            self._in_use += 1
+
+        contexts = self._contexts
+        page = None
+        try:
+            context: BrowserContext = await contexts.get()
+            try:
+                page = await context.new_page()
+                self._pages_served += 1
+                yield page
+            finally:
+                try:
+                    if page:
+                        await page.close()
+                finally:
+                    contexts.put_nowait(context)
+        finally:
+            self._in_use -= 1
+
 class HNXCrawler:
-    _browser: Browser = None
-    _playwright: Playwright = None
+    _pool: BrowserPool = None
+    _start_lock = asyncio.Lock()
+    # Chỉ cần HTML của bảng, các tài nguyên này chỉ làm chậm việc tải trang
+    BLOCKED_RESOURCES = {"image", "font", "media", "stylesheet"}
+    # Trích xuất các ô của bảng ngay trong trình duyệt, chỉ trả về JSON gọn
+    EXTRACT_ROWS_JS = """() => Array.from(document.querySelectorAll('table#_tableDatas tbody tr'))
+        .map(tr => Array.from(tr.querySelectorAll(':scope > td'), td => td.innerText.trim()))
+        .filter(cells => cells.length >= 5)"""
 
     @classmethod
-    async def get_browser(cls) -> Browser:
-        if not cls._browser or not cls._browser.is_connected():
-            cls._playwright = await async_playwright().start()
-            cls._browser = await cls._playwright.chromium.launch(
-                headless=True,
-                args=["--no-sandbox", "--disable-dev-shm-usage"]
-            )
-        return cls._browser
+    async def block_resources(cls, route: Route) -> None:
+        if route.request.resource_type in cls.BLOCKED_RESOURCES:
+            await route.abort()
+        else:
+            await route.continue_()
+
+    @classmethod
+    async def start(cls) -> None:
+        pool = BrowserPool(route_handler=cls.block_resources)
+        try:
+            await pool.start()
+        except Exception:
+            await pool.close()
+            raise
+        # Chỉ gán pool khi Chromium đã khởi động thành công
+        cls._pool = pool
+
+    @classmethod
+    async def close(cls) -> None:
+        if cls._pool:
+            await cls._pool.close()
+            cls._pool = None
 
     @staticmethod
-    def parse_html(html: str) -> List["StockItem"]:
-        soup = BeautifulSoup(html, "html.parser")
+    def parse_rows(rows: List[List[str]]) -> List["StockItem"]:
         return [
             StockItem(
-                ticker=cols[1].get_text(strip=True),
-                name=cols[2].get_text(strip=True),
-                date=datetime.strptime(cols[3].get_text(strip=True), "%d/%m/%Y").strftime("%Y-%m-%d"),
-                reason=cols[4].get_text(strip=True).replace("- ", ""),
+                ticker=cols[1],
+                name=cols[2],
+                date=_to_iso(cols[3]),
+                reason=cols[4].replace("- ", ""),
                 exchange="HNX"
             )
-            for row in soup.select("table#_tableDatas tbody tr")
-            if (cols := row.find_all("td")) and len(cols) >= 5
+            for cols in rows if len(cols) >= 5
         ]
 
     @classmethod
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
+    def parse_html(cls, html: str) -> List["StockItem"]:
+        doc = lhtml.fromstring(html)
+        return cls.parse_rows([
+            [_WS_RE.sub(" ", col.text_content()).strip() for col in row.iterchildren("td")]
+            for row in _HNX_ROWS(doc)
+        ])
+
+    @classmethod
     async def crawl(cls) -> List["StockItem"]:
-        browser = await cls.get_browser()
-        context = await browser.new_context()
+        return await with_retry(cls._crawl_once)
 
-        try:
-            page = await context.new_page()
+    @classmethod
+    async def _crawl_once(cls) -> List["StockItem"]:
+        # Khóa để các request đồng thời không khởi động nhiều Chromium khi chưa khởi tạo
+        async with cls._start_lock:
+            if not cls._pool:
+                await cls.start()
+
+        async with cls._pool.page() as page:
             await page.goto(settings.HNX_URL, wait_until="domcontentloaded", timeout=60000)
 
             items = []
@@ -203,15 +395,14 @@ class HNXCrawler:
             for _ in range(settings.MAX_PAGES):
 
                 try:
-                    await page.wait_for_selector("table#_tableDatas", timeout=10000)
+                    await page.wait_for_selector("table#_tableDatas tbody tr", timeout=10000)
                 except Exception:
                     logging.info("Không tìm thấy bảng dữ liệu, kết thúc crawl.")
                     break
 
-                content = await page.content()
-                new_items = cls.parse_html(content)
+                new_items = cls.parse_rows(await page.evaluate(cls.EXTRACT_ROWS_JS))
 
-                # Nếu dữ liệu trống, thử đợi thêm 1 giây rồi lấy lại nội dung trang
+                # Nếu dữ liệu trống, thử đợi thêm 1 giây rồi lấy lại toàn bộ nội dung trang
                 if not new_items:
                     logging.warning("Trang hiện tại không có dữ liệu. Đợi thêm và thử lại.")
                     await asyncio.sleep(1)
@@ -253,8 +444,76 @@ class HNXCrawler:
                 await page.wait_for_timeout(500)  # Đợi thêm 0.5 giây nếu cần
 
             return items
-        finally:
-            await context.close()
+
+# Cache
+class StocksCache:
+    """Giữ kết quả /stocks trong bộ nhớ, các request đồng thời dùng chung một lần crawl."""
+    _payload: dict = None
+    _fetched_at = 0.0
+    _lock = asyncio.Lock()
+
+    @classmethod
+    def _fresh(cls) -> bool:
+        return cls._payload is not None and time.monotonic() - cls._fetched_at < settings.CACHE_TTL
+
+    @staticmethod
+    async def _crawl_both() -> tuple:
+        tasks = [asyncio.create_task(HSXCrawler.crawl()), asyncio.create_task(HNXCrawler.crawl())]
+        try:
+            return tuple(await asyncio.gather(*tasks))
+        except BaseException:
+            # Một bên lỗi thì hủy bên còn lại, tránh Chromium tiếp tục chạy vô ích
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    @classmethod
+    async def get(cls, refresh: bool = False) -> dict:
+        if not refresh and cls._fresh():
+            return cls._payload
+
+        arrived_at = time.monotonic()
+        async with cls._lock:
+            # Request khác có thể đã crawl xong trong lúc chờ khóa
+            if not refresh and cls._fresh():
+                return cls._payload
+            # Với refresh, dùng lại kết quả của lần crawl kết thúc sau khi request này đến
+            if refresh and cls._payload is not None and cls._fetched_at > arrived_at:
+                return cls._payload
+
+            # HSX và HNX độc lập nên crawl song song
+            hsx_data, hnx_data = await cls._crawl_both()
+            payload = {
+                "data": hsx_data + hnx_data,
+                "metadata": {
+                    "total": len(hsx_data) + len(hnx_data),
+                    "generated_at": datetime.utcnow().isoformat()
+                }
+            }
+            # Một sàn trả về rỗng thường là do crawl lỗi, không lưu vào cache
+            if not hsx_data or not hnx_data:
+                logging.warning("Dữ liệu HSX hoặc HNX trống, không lưu vào cache.")
+                return payload
+
+            cls._payload = payload
+            cls._fetched_at = time.monotonic()
+            return payload
+
+# Lifecycle
+@app.on_event("startup")
+async def startup():
+    await HSXCrawler.start()
+    # Chromium lỗi không được làm hỏng cả worker; _crawl_once sẽ thử khởi động lại
+    try:
+        await HNXCrawler.start()
+    except Exception as e:
+        logging.exception(f"Không khởi động được trình duyệt HNX: {e}")
+
+@app.on_event("shutdown")
+async def shutdown():
+    await HSXCrawler.close()
+    await HNXCrawler.close()
 
 # API Endpoints
 @app.get("/")
@@ -266,25 +525,10 @@ async def health_check():
     return {"status": "ok", "timestamp": datetime.utcnow().isoformat()}
 
 @app.get("/stocks", response_model=APIResponse)
-async def get_stocks(request: Request):
+async def get_stocks(request: Request, refresh: bool = False):
     try:
-        # HSX
-        hsx_data = []
-        for page in range(1, settings.MAX_PAGES + 1):
-            if not (rows := await HSXCrawler.fetch_page(page)):
-                break
-            hsx_data.extend(HSXCrawler.process_data(rows))
-
-        # HNX
-        hnx_data = await HNXCrawler.crawl()
-
-        return {
-            "data": hsx_data + hnx_data,
-            "metadata": {
-                "total": len(hsx_data) + len(hnx_data),
-                "generated_at": datetime.utcnow().isoformat()
-            }
-        }
+        # Trả về ORJSONResponse trực tiếp để bỏ qua bước validate/encode lại theo response_model
+        return ORJSONResponse(await StocksCache.get(refresh=refresh))
     except Exception as e:
         logging.exception("An error occurred while crawling stocks")
         raise HTTPException(status_code=500, detail=f"Crawling failed: {str(e)}")